@@ -6,7 +6,6 @@ import logging.handlers
 import os
 import sys
 from collections import defaultdict
-from lxml import etree
 
 from ocf.constants import SUCCESS, NOT_RUNNING
 from ocf.types import from_ocf
@@ -114,6 +113,7 @@ class ResourceAgent(object):
 
     def __init__(self, environ=None, node=None):
         self.environ = (environ if environ is not None else os.environ)
+        self.meta_cache = {}
         self.node = (node if node is not None else self.meta_on_node)
         self.parameter_cache = {}
         self.attribute_cache = {}
@@ -205,7 +205,11 @@ class ResourceAgent(object):
     def meta(self, name, type=str, default=None):
         """Get meta resource parameter"""
         # pylint: disable=locally-disabled, redefined-builtin
-        return self.param(('CRM_meta_%s' % name), type, default)
+        key = (name, type, default)
+        if key not in self.meta_cache:
+            value = self.param(('CRM_meta_%s' % name), type, default)
+            self.meta_cache[key] = value
+        return self.meta_cache[key]
 
     @property
     def meta_clone(self):
@@ -451,6 +455,9 @@ class ResourceAgent(object):
     @action('meta-data', timeout=5)
     def action_metadata(self):
         """Show resource metadata"""
+        # Import lxml only when needed, since most invocations (such as
+        # recurring monitors) never generate any XML
+        from lxml import etree
         xml = etree.Element('resource-agent', name=self.name)
         etree.SubElement(xml, 'version').text = self.version
         if self.__doc__:
@@ -483,9 +490,11 @@ class ResourceAgent(object):
                         xml_action.set('interval', str(details.interval))
                     if details.timeout is not None:
                         xml_action.set('timeout', str(details.timeout))
-        sys.stdout.write(etree.tostring(xml, xml_declaration=True,
-                                        encoding='utf-8', doctype=DOCTYPE,
-                                        pretty_print=True).decode())
+        stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+        stdout.write(etree.tostring(xml, xml_declaration=True,
+                                    encoding='utf-8', doctype=DOCTYPE,
+                                    pretty_print=True))
+        stdout.flush()
         return SUCCESS
 
     @staticmethod
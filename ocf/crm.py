@@ -1,7 +1,6 @@
 """Cluster resource manager"""
 
 import subprocess
-from lxml import etree
 from ocf.constants import ERR_CONFIGURED
 from ocf.exceptions import GenericError
 from ocf.types import from_ocf, to_ocf
@@ -13,6 +12,9 @@ class ClusterResourceManager(object):
     @staticmethod
     def _crm_mon_xml():
         """Invoke crm_mon to query cluster status as XML"""
+        # Import lxml only when needed, since node names are usually
+        # available from notification variables
+        from lxml import etree
         command = ('crm_mon', '--as-xml')
         try:
             output = subprocess.check_output(command, stderr=subprocess.STDOUT)
@@ -54,18 +54,25 @@ to accept connections only once the node is in the "master" state.
 
 """
 
+import errno
+import mmap
 import os
 import pwd
 import re
 import stat
 import subprocess
-from datetime import datetime
-from uuid import UUID, uuid4
+import tempfile
+import time
+try:
+    from sys import intern
+except ImportError:
+    # Python 2 provides intern() as a builtin
+    pass
 
 import ocf
 from systemcloud.agent import BootstrappingAgent
 
-ZERO_UUID_STRING = str(UUID(int=0))
+ZERO_UUID_STRING = intern('00000000-0000-0000-0000-000000000000')
 WSREP_STATE_SYNCED = 4
 
 DEFAULT_SERVICE = "mariadb.service"
@@ -73,29 +80,95 @@ DEFAULT_CONFIG = "/etc/my.cnf.d"
 DEFAULT_DATADIR = "/var/lib/mysql"
 DEFAULT_USER = "mysql"
 
+REGENERATED = b'# Last regenerated:'
+SAFE_TO_BOOTSTRAP = b'safe_to_bootstrap:'
+RECOVERED_POSITION = b'Recovered position:'
+
+UUID_RE = re.compile(r'^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-'
+                     r'[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\Z')
+SAFE_TO_BOOTSTRAP_RE = re.compile(
+    br'^[ \t]*safe_to_bootstrap:[ \t]*(\S+)[ \t]*$', re.MULTILINE)
+WSREP_LOCAL_STATE_RE = re.compile(r'^\s*wsrep_local_state\s+(?P<state>\d+)\s*$')
+
+
+def open_noatime(filename, mode='r'):
+    """Open file without updating its access time
+
+    O_NOATIME is permitted only for the owner of the file (or with
+    CAP_FOWNER), so fall back to a normal open if it is refused.
+    """
+    flags = (os.O_RDWR if '+' in mode else os.O_RDONLY)
+    try:
+        fd = os.open(filename, flags | getattr(os, 'O_NOATIME', 0))
+    except OSError as e:
+        if e.errno != errno.EPERM:
+            raise
+        fd = os.open(filename, flags)
+    return os.fdopen(fd, mode)
+
+
+def is_unchanged(filename, contents):
+    """Check if file already has the specified contents
+
+    Any "Last regenerated" timestamp line is ignored.
+    """
+    try:
+        with open_noatime(filename, 'rb') as f:
+            existing = f.read()
+    except OSError:
+        return False
+    def significant(data):
+        """Get significant lines"""
+        return [x for x in data.splitlines() if not x.startswith(REGENERATED)]
+    return significant(existing) == significant(contents)
+
 
 class GaleraState(object):
-    """Galera database state"""
+    """Galera database state
+
+    Instances are shared between all users of the same state string,
+    and so are immutable once constructed.
+    """
     # pylint: disable=locally-disabled, too-few-public-methods
 
+    __slots__ = ('uuid', 'seqno')
+
+    parsed = {}
+
     def __init__(self, string=None, uuid=None, seqno=None):
         if string is not None:
             try:
                 (uuid, seqno) = string.split(':')
             except ValueError:
                 raise ValueError("Malformed state %s" % string)
-        try:
-            UUID(uuid)
-            self.uuid = uuid
-        except ValueError:
+        if not UUID_RE.match(uuid):
             raise ValueError("Malformed UUID %s" % uuid)
         try:
-            self.seqno = int(seqno)
+            seqno = int(seqno)
         except ValueError:
             raise ValueError("Malformed sequence number %s" % seqno)
         # Work around an apparent Galera bug
-        if self.seqno == ((1 << 64) - 1):
-            self.seqno = -1
+        if seqno == ((1 << 64) - 1):
+            seqno = -1
+        object.__setattr__(self, 'uuid', intern(str(uuid)))
+        object.__setattr__(self, 'seqno', seqno)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Cannot modify %s" % name)
+
+    def __delattr__(self, name):
+        raise AttributeError("Cannot delete %s" % name)
+
+    @classmethod
+    def parse(cls, string):
+        """Parse state string
+
+        Peers commonly report identical states (e.g. when all nodes
+        of a new cluster are unstarted), so parsed states are cached.
+        """
+        if string not in cls.parsed:
+            cls.parsed[string] = cls(string)
+        return cls.parsed[string]
 
     def __str__(self):
         return '%s:%d' % (self.uuid, self.seqno)
@@ -122,7 +195,11 @@ class GaleraAgent(BootstrappingAgent):
                          description="User name")
 
     cluster_uuid = ocf.InstanceNameAttribute('uuid', str)
-    state = ocf.NodeInstanceNameAttribute('state', GaleraState)
+    state = ocf.NodeInstanceNameAttribute('state', GaleraState.parse)
+
+    def __init__(self, environ=None, node=None):
+        super(GaleraAgent, self).__init__(environ=environ, node=node)
+        self.grastate_file_cache = None
 
     @property
     def config_file(self):
@@ -137,7 +214,10 @@ class GaleraAgent(BootstrappingAgent):
     @property
     def grastate_file(self):
         """Galera state file path"""
-        return os.path.join(self.datadir, 'grastate.dat')
+        if self.grastate_file_cache is None:
+            self.grastate_file_cache = os.path.join(self.datadir,
+                                                    'grastate.dat')
+        return self.grastate_file_cache
 
     @property
     def gvwstate_file(self):
@@ -166,7 +246,7 @@ class GaleraAgent(BootstrappingAgent):
         config = [
             "# Autogenerated by systemcloud - do not edit\n",
             "#\n",
-            "# Last regenerated: %s\n" % datetime.now(),
+            "# Last regenerated: %s\n" % time.strftime('%Y-%m-%d %H:%M:%S'),
             "#\n",
             "# This node: %s\n" % self.node,
             "# All nodes: %s\n" % ' '.join(self.all_unames),
@@ -192,12 +272,28 @@ class GaleraAgent(BootstrappingAgent):
         ]
         for filename, contents in ((self.config_file, config),
                                    (self.init_script_file, script)):
-            with open(filename, 'wb') as f:
-                f.writelines(contents)
-                f.flush()
-                os.fchmod(f.fileno(), (stat.S_IRUSR | stat.S_IWUSR |
-                                       stat.S_IRGRP | stat.S_IROTH))
-                os.fsync(f.fileno())
+            contents = ''.join(contents).encode()
+            # Avoid rewriting an unchanged file
+            if is_unchanged(filename, contents):
+                continue
+            # Write via a temporary file and rename into place, so
+            # that a concurrently starting service can never observe
+            # a partially written file
+            (fd, tmpfile) = tempfile.mkstemp(
+                dir=os.path.dirname(filename),
+                prefix='.%s.' % os.path.basename(filename))
+            try:
+                try:
+                    os.write(fd, contents)
+                    os.fchmod(fd, (stat.S_IRUSR | stat.S_IWUSR |
+                                   stat.S_IRGRP | stat.S_IROTH))
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                os.rename(tmpfile, filename)
+            except Exception:
+                os.unlink(tmpfile)
+                raise
         if promoting and not masters:
             self.force_safe_to_bootstrap()
 
@@ -213,45 +309,52 @@ class GaleraAgent(BootstrappingAgent):
         a nonexistent file acts as an implicit "safe_to_bootstrap: 1"
         anyway.
         """
-        try:
-            f = open(self.grastate_file, 'r+b')
-        except IOError:
+        if not os.path.exists(self.grastate_file):
             return
-        with f:
-            while True:
-                pos = f.tell()
-                line = f.readline()
-                if not line:
-                    break
-                (line, changed) = re.subn(r'^\s*safe_to_bootstrap:\s*(\S+)\s*$',
-                                          lambda m: '1'.ljust(len(m.group(0))),
-                                          line)
-                if changed:
-                    f.seek(pos)
-                    f.write(line)
-                    f.flush()
-                    os.fsync(f.fileno())
-                    break
+        with open_noatime(self.grastate_file, 'r+b') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return
+            mm = mmap.mmap(f.fileno(), 0)
+            try:
+                # Skip directly to the line containing the flag, if any
+                index = mm.find(SAFE_TO_BOOTSTRAP)
+                if index < 0:
+                    return
+                line = (mm.rfind(b'\n', 0, index) + 1)
+                m = SAFE_TO_BOOTSTRAP_RE.search(mm, line)
+                if m is None or m.group(1) == b'1':
+                    return
+                (start, end) = m.span(1)
+                mm[start:end] = b'1'.ljust(end - start)
+                mm.flush()
+            finally:
+                mm.close()
+            os.fsync(f.fileno())
 
     def read_grastate(self):
         """Read state from Galera state file"""
-        raw = {}
+        uuid = None
+        seqno = None
         try:
-            f = open(self.grastate_file, 'rb')
-        except IOError:
+            f = open_noatime(self.grastate_file, 'r')
+        except OSError:
             self.logger.error("Missing state file %s" % self.grastate_file)
             return None
         with f:
-            for lineno, line in enumerate(f, start=1):
-                if re.match(r'^\s*(#.*)?$', line):
-                    continue
-                m = re.match(r'^\s*(?P<key>\w+):\s*(?P<value>.*?)\s*$', line)
-                if not m:
-                    raise ocf.GenericError("Corrupt %s on line %d" %
-                                           (self.grastate_file, lineno))
-                raw[m.group('key')] = m.group('value')
-        uuid = raw.get('uuid')
-        seqno = raw.get('seqno')
+            lines = f.read().splitlines()
+        for lineno, line in enumerate(lines, start=1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('uuid:'):
+                uuid = line[5:].strip()
+            elif line.startswith('seqno:'):
+                seqno = line[6:].strip()
+            elif ':' not in line:
+                raise ocf.GenericError("Corrupt %s on line %d" %
+                                       (self.grastate_file, lineno))
+            if uuid is not None and seqno is not None:
+                break
         if uuid is None:
             raise ocf.GenericError("Missing UUID in %s" % self.grastate_file)
         if seqno is None:
@@ -272,21 +375,25 @@ class GaleraAgent(BootstrappingAgent):
         information is by parsing the log created from running with
         wsrep_recover=on.
         """
-        logfile = os.path.join(self.datadir, 'wsrep-recovery-%s.log' % uuid4())
+        logfile = os.path.join(self.datadir, 'wsrep-recovery-%d-%d.log' %
+                               (os.getpid(), time.time()))
         self.logger.info("Attempting recovery to %s", logfile)
         self.reconfigure(wsrep_recovery_log=logfile)
         self.systemctl_start(self.service)
         # Service should have stopped immediately after performing
         # recovery, but force a stop just in case.
         self.systemctl_stop(self.service)
-        pattern = re.compile(r'^.*Recovered position:\s*(?P<state>\S+)$')
+        position = None
         with open(logfile, 'rb') as f:
-            try:
-                m = next(m for m in (pattern.match(line) for line in f) if m)
-            except StopIteration:
-                raise ocf.GenericError("Recovery failed: see %s" % logfile)
+            for line in f:
+                index = line.find(RECOVERED_POSITION)
+                if index >= 0:
+                    position = line[index + len(RECOVERED_POSITION):].strip()
+                    break
+        if not position:
+            raise ocf.GenericError("Recovery failed: see %s" % logfile)
         try:
-            state = GaleraState(m.group('state'))
+            state = GaleraState(position.decode())
         except ValueError as e:
             raise ocf.GenericError("%s: see %s" % (str(e), logfile))
         self.logger.info("Recovered %s from %s", state, logfile)
@@ -326,14 +433,18 @@ class GaleraAgent(BootstrappingAgent):
             self.logger.info("Waiting for reported state from %s",
                              ' '.join(x.node for x in unreported))
             return None
-        if self.cluster_uuid is not None:
-            uuid = self.cluster_uuid
+        cluster_uuid = self.cluster_uuid
+        if cluster_uuid is not None:
+            uuid = intern(cluster_uuid)
             self.logger.info("Cluster UUID is %s", uuid)
         else:
-            uuids = set(x.uuid for x in peers if x.uuid != ZERO_UUID_STRING)
-            if len(uuids) > 1:
-                raise ocf.ConfiguredError("Multiple UUIDs in new cluster")
-            uuid = (uuids.pop() if uuids else ZERO_UUID_STRING)
+            uuid = ZERO_UUID_STRING
+            for peer in peers:
+                if peer.uuid == ZERO_UUID_STRING or peer.uuid == uuid:
+                    continue
+                if uuid != ZERO_UUID_STRING:
+                    raise ocf.ConfiguredError("Multiple UUIDs in new cluster")
+                uuid = peer.uuid
             self.logger.info("Assuming new cluster UUID %s", uuid)
         members = [x for x in peers if x.uuid == uuid]
         if not members:
@@ -344,8 +455,9 @@ class GaleraAgent(BootstrappingAgent):
                 self.logger.info("Waiting for known state from %s",
                                  ' '.join(x.node for x in unknown))
                 return None
-        bootstrap = max(members, key=lambda x: (x.seqno, x.node))
-        self.logger.info("Bootstrapping %s" % bootstrap.node)
+        # Node names are unique, so the peer itself is never compared
+        (_seqno, _node, bootstrap) = max((x.seqno, x.node, x) for x in members)
+        self.logger.info("Bootstrapping %s", bootstrap.node)
         return bootstrap
 
     def mysql_exec(self, sql):
@@ -369,7 +481,8 @@ class GaleraAgent(BootstrappingAgent):
         self.state = self.read_grastate() or self.recover_grastate()
         # Check that UUID matches cluster UUID, if already set
         if self.cluster_uuid is not None:
-            if self.uuid not in (ZERO_UUID_STRING, self.cluster_uuid):
+            uuid = self.uuid
+            if uuid != ZERO_UUID_STRING and uuid != self.cluster_uuid:
                 raise ocf.GenericError("UUID does not match cluster UUID")
 
     @property
@@ -382,7 +495,8 @@ class GaleraAgent(BootstrappingAgent):
         """Start master service"""
         # Check that UUID matches cluster UUID, if already set
         if self.cluster_uuid is not None:
-            if self.uuid not in (ZERO_UUID_STRING, self.cluster_uuid):
+            uuid = self.uuid
+            if uuid != ZERO_UUID_STRING and uuid != self.cluster_uuid:
                 raise ocf.GenericError("UUID does not match cluster UUID")
         # Delete empty primary component state file, if present
         self.delete_empty_gvwstate()
@@ -393,7 +507,8 @@ class GaleraAgent(BootstrappingAgent):
         state = self.read_grastate()
         if state is None:
             raise ocf.GenericError("Unable to determine state after promotion")
-        if self.uuid not in (ZERO_UUID_STRING, state.uuid):
+        uuid = self.uuid
+        if uuid != ZERO_UUID_STRING and uuid != state.uuid:
             raise ocf.GenericError("UUID changed unexpectedly after promotion")
         self.state = state
         # Record cluster UUID if not already set
@@ -416,7 +531,7 @@ class GaleraAgent(BootstrappingAgent):
         if not self.systemctl_is_active(self.service):
             return False
         output = self.mysql_exec("SHOW STATUS LIKE 'wsrep_local_state'")
-        m = re.match(r'^\s*wsrep_local_state\s+(?P<state>\d+)\s*$', output)
+        m = WSREP_LOCAL_STATE_RE.match(output)
         if not m:
             raise ocf.GenericError("Unable to determine state:\n%s" % output)
         state = int(m.group('state'))
@@ -11,6 +11,11 @@ distribution configuration files.
 import re
 import subprocess
 from collections import namedtuple
+try:
+    from sys import intern
+except ImportError:
+    # Python 2 provides intern() as a builtin
+    pass
 
 import ocf
 from systemcloud.agent import BootstrappingAgent
@@ -18,11 +23,49 @@ from systemcloud.agent import BootstrappingAgent
 DEFAULT_SERVICE = "rabbitmq-server.service"
 DEFAULT_CONFIG = "/etc/rabbitmq/rabbitmq-systemcloud.conf"
 
+COMMA_RE = re.compile(r'\s*,\s*')
+
+ERL_LOAD_RABBIT = """
+case application:load(rabbit) of
+    ok                           -> ok;
+    {error, {already_loaded, _}} -> ok
+end
+"""
+ERL_READ_STATE = """
+try
+    Known = rabbit_mnesia:cluster_nodes(all),
+    Running = rabbit_mnesia:cluster_nodes(running),
+    mnesia:start(),
+    Version = mnesia_schema:version(),
+    {Version, Known, Running}
+catch
+    throw:{error, {corrupt_or_missing_cluster_files, _, _}} ->
+        {{0,0},[],[]}
+after
+    mnesia:stop()
+end
+"""
+ERL_APP_IS_RUNNING = "rabbit:is_running()"
+ERL_ENSURE_APP_STOPPED = """
+case %s of
+    true  -> rabbit:stop();
+    false -> ok
+end
+""" % ERL_APP_IS_RUNNING
+ERL_ENSURE_MNESIA_DIR = "rabbit_mnesia:ensure_mnesia_dir()"
+ERL_RESET_CLUSTER_STATUS = "rabbit_node_monitor:reset_cluster_status()"
+ERL_JOIN_CLUSTER = "rabbit_mnesia:join_cluster('%s', disc)"
+JOIN_CLUSTER_OK = ('ok', '{ok,already_member}')
+ERL_UPDATE_CLUSTER_NODES = "rabbit_mnesia:update_cluster_nodes('%s')"
+ERL_FORGET_CLUSTER_NODE = "rabbit_mnesia:forget_cluster_node('%s', false)"
+
 
 class RabbitVersion(namedtuple('RabbitVersion', ['major', 'minor'])):
     """RabbitMQ table version number"""
     # pylint: disable=locally-disabled, too-few-public-methods
 
+    __slots__ = ()
+
     def __str__(self):
         return '{%d,%d}' % (self.major, self.minor)
 
@@ -33,27 +76,57 @@ class RabbitState(object):
     """RabbitMQ node state"""
     # pylint: disable=locally-disabled, too-few-public-methods
 
+    __slots__ = ('version', 'known', 'running')
+
     @staticmethod
     def _rabbits(string):
-        return [x.strip() for x in string.split(',')] if string else []
+        """Split an already-stripped comma-separated node list"""
+        return COMMA_RE.split(string) if string else []
+
+    @staticmethod
+    def _parse(string):
+        """Split "{{Major,Minor},[Known],[Running]}" into its fields"""
+        body = string.strip()
+        if not (body.startswith('{') and body.endswith('}')):
+            raise ValueError
+        body = body[1:-1]
+        version_start = body.index('{')
+        version_end = body.index('}', version_start)
+        known_start = body.index('[', version_end)
+        known_end = body.index(']', known_start)
+        running_start = body.index('[', known_end)
+        running_end = body.index(']', running_start)
+        if (body[:version_start].strip() or
+                body[version_end + 1:known_start].strip() != ',' or
+                body[known_end + 1:running_start].strip() != ',' or
+                body[running_end + 1:].strip()):
+            raise ValueError
+        (major, minor) = body[version_start + 1:version_end].split(',')
+        (major, minor) = (major.strip(), minor.strip())
+        if not (major.isdigit() and minor.isdigit()):
+            raise ValueError
+        return (int(major), int(minor),
+                body[known_start + 1:known_end].strip(),
+                body[running_start + 1:running_end].strip())
 
     def __init__(self, string):
-        m = re.match(r'^\s*\{\s*'
-                     r'\{\s*(?P<major>\d+)\s*,\s*(?P<minor>\d+)\s*\}\s*,\s*'
-                     r'\[\s*(?P<known>.*?)\s*\]\s*,\s*'
-                     r'\[\s*(?P<running>.*?)\s*\]\s*\}\s*$', string)
-        if not m:
+        try:
+            (major, minor, known, running) = self._parse(string)
+        except ValueError:
             raise ValueError("Malformed state %s" % string)
-        self.version = RabbitVersion(int(m.group('major')),
-                                     int(m.group('minor')))
-        self.known = self._rabbits(m.group('known'))
-        self.running = self._rabbits(m.group('running'))
-        if not set(self.running) <= set(self.known):
-            raise ValueError("Unknown running nodes in %s", self)
+        self.version = RabbitVersion(major, minor)
+        self.known = self._rabbits(known)
+        self.running = self._rabbits(running)
+        known = set(self.known)
+        for rabbit in self.running:
+            if rabbit not in known:
+                raise ValueError("Unknown running node %s in %s" %
+                                 (rabbit, string))
 
     def __str__(self):
-        return '{%s,[%s],[%s]}' % (self.version, ','.join(self.known),
-                                   ','.join(self.running))
+        (major, minor) = self.version
+        return '{{%d,%d},[%s],[%s]}' % (major, minor, ','.join(self.known),
+                                        ','.join(self.running))
 
     def __bool__(self):
         return self.version > EmptyVersion
@@ -74,10 +147,17 @@ class RabbitAgent(BootstrappingAgent):
 
     state = ocf.NodeInstanceNameAttribute('state', RabbitState)
 
+    def __init__(self, environ=None, node=None):
+        super(RabbitAgent, self).__init__(environ=environ, node=node)
+        self.rabbit_cache = None
+
     @property
     def rabbit(self):
         """RabbitMQ name for this node"""
-        return 'rabbit@%s' % self.node.split('.')[0]
+        if self.rabbit_cache is None:
+            self.rabbit_cache = intern('rabbit@%s' %
+                                       self.node.partition('.')[0])
+        return self.rabbit_cache
 
     @property
     def known_rabbits(self):
@@ -87,8 +167,9 @@ class RabbitAgent(BootstrappingAgent):
         and so reflects the list as at the state of the most recent
         shutdown (or crash).
         """
-        if self.state is not None:
-            return self.state.known
+        state = self.state
+        if state is not None:
+            return state.known
 
     @property
     def running_rabbits(self):
@@ -98,8 +179,9 @@ class RabbitAgent(BootstrappingAgent):
         and so reflects the list as at the state of the most recent
         shutdown (or crash).
         """
-        if self.state is not None:
-            return self.state.running
+        state = self.state
+        if state is not None:
+            return state.running
 
     @property
     def schema_version(self):
@@ -109,15 +191,17 @@ class RabbitAgent(BootstrappingAgent):
         and so reflects the version as at the state of the most recent
         shutdown (or crash).
         """
-        if self.state is not None:
-            return self.state.version
+        state = self.state
+        if state is not None:
+            return state.version
 
     @staticmethod
     def rabbitmqctl(*args):
         """Perform an action via rabbitmqctl"""
         command = ('rabbitmqctl',) + args
         try:
-            output = subprocess.check_output(command, stderr=subprocess.STDOUT)
+            output = subprocess.check_output(command, stderr=subprocess.STDOUT,
+                                             universal_newlines=True)
             return output.rstrip('\n')
         except subprocess.CalledProcessError as e:
             raise ocf.GenericError(e.output or e.returncode)
@@ -126,6 +210,15 @@ class RabbitAgent(BootstrappingAgent):
         """Evaluate Erlang code via rabbitmqctl"""
         return self.rabbitmqctl('eval', erl)
 
+    def rabbitmqctl_eval_many(self, *erls):
+        """Evaluate a sequence of Erlang expressions via a single rabbitmqctl
+
+        Each rabbitmqctl invocation must start up a new Erlang VM, so
+        sequences of expressions should be evaluated in one go where
+        possible.  The result is that of the final expression.
+        """
+        return self.rabbitmqctl_eval('%s.' % ', '.join(x.strip() for x in erls))
+
     def rabbitmqctl_force_boot(self):
         """Force boot via rabbitmqctl"""
         self.rabbitmqctl('force_boot')
@@ -156,46 +249,25 @@ class RabbitAgent(BootstrappingAgent):
 
     @property
     def app_is_running(self):
-        """Check if application is running via rabbitmqctl"""
-        return self.rabbitmqctl_eval('rabbit:is_running().') == 'true'
-
-    def read_state(self):
-        """Get schema version and cluster nodes via rabbitmqctl"""
-        erl = """
-        try
-            Known = rabbit_mnesia:cluster_nodes(all),
-            Running = rabbit_mnesia:cluster_nodes(running),
-            mnesia:start(),
-            Version = mnesia_schema:version(),
-            {Version, Known, Running}
-        catch
-            throw:{error, {corrupt_or_missing_cluster_files, _, _}} ->
-                {{0,0},[],[]}
-        after
-            mnesia:stop()
-        end.
-        """
-        state = RabbitState(self.rabbitmqctl_eval(erl))
-        self.logger.info("State is %s" % state)
-        return state
+        """Check if application is running via rabbitmqctl
 
-    def ensure_application_loaded(self, application='rabbit'):
-        """Ensure that application is loaded"""
-        erl = """
-        case application:load(%s) of
-            ok                           -> ok;
-            {error, {already_loaded, _}} -> ok
-        end.
-        """ % application
-        self.rabbitmqctl_eval(erl)
+        The application cannot be running unless the service is
+        running, in which case there is no need to ask rabbitmqctl.
+        """
+        return (self.service_is_running and
+                self.rabbitmqctl_eval_many(ERL_APP_IS_RUNNING) == 'true')
 
-    def ensure_mnesia_dir(self):
-        """Ensure that Mnesia database directory exists"""
-        self.rabbitmqctl_eval('rabbit_mnesia:ensure_mnesia_dir().')
+    def read_state(self, ensure_app_stopped=False):
+        """Get schema version and cluster nodes via rabbitmqctl
 
-    def reset_cluster_status(self):
-        """Reset cluster status files"""
-        self.rabbitmqctl_eval('rabbit_node_monitor:reset_cluster_status().')
+        The application may optionally be stopped first (if running)
+        as part of the same rabbitmqctl invocation.
+        """
+        erls = (((ERL_ENSURE_APP_STOPPED,) if ensure_app_stopped else ()) +
+                (ERL_READ_STATE,))
+        state = RabbitState(self.rabbitmqctl_eval_many(*erls))
+        self.logger.info("State is %s" % state)
+        return state
 
     def join(self, rabbit):
         """Join cluster
@@ -203,10 +275,15 @@ class RabbitAgent(BootstrappingAgent):
         This joins a virgin node into a new cluster
         """
         self.logger.info("Joining via %s", rabbit)
-        self.ensure_application_loaded()
-        self.ensure_mnesia_dir()
-        self.reset_cluster_status()
-        self.rabbitmqctl_join_cluster(rabbit)
+        result = self.rabbitmqctl_eval_many(ERL_LOAD_RABBIT,
+                                            ERL_ENSURE_MNESIA_DIR,
+                                            ERL_RESET_CLUSTER_STATUS,
+                                            ERL_JOIN_CLUSTER % rabbit)
+        # Join failures are returned as {error, Reason} rather than
+        # raised, and so will not cause rabbitmqctl to fail
+        if result not in JOIN_CLUSTER_OK:
+            raise ocf.GenericError("Failed to join via %s: %s" %
+                                   (rabbit, result))
 
     def rejoin(self, rabbit):
         """Rejoin cluster
@@ -215,37 +292,84 @@ class RabbitAgent(BootstrappingAgent):
         new cluster peer).
         """
         self.logger.info("Rejoining via %s", rabbit)
-        self.ensure_application_loaded()
-        self.rabbitmqctl_update_cluster_nodes(rabbit)
+        self.rabbitmqctl_eval_many(ERL_LOAD_RABBIT,
+                                   ERL_UPDATE_CLUSTER_NODES % rabbit)
 
-    def forget(self, rabbit):
-        """Forget cluster peer"""
-        self.logger.info("Forgetting %s", rabbit)
-        self.rabbitmqctl_forget_cluster_node(rabbit)
+    def forget(self, *rabbits):
+        """Forget cluster peers"""
+        self.logger.info("Forgetting %s", ' '.join(rabbits))
+        self.rabbitmqctl_eval_many(*(ERL_FORGET_CLUSTER_NODE % x
+                                     for x in rabbits))
 
     def choose_bootstrap(self):
         """Choose a bootstrap node"""
-        peers = self.all_peers
-        unreported = [x for x in peers if x.state is None]
-        if unreported:
+        peers = [(x, x.state) for x in self.all_peers]
+        if any(state is None for (_x, state) in peers):
             self.logger.info("Waiting for reported state from %s",
-                             ' '.join(x.node for x in unreported))
+                             ' '.join(x.node for (x, state) in peers
+                                      if state is None))
             return None
-        bootstrap = max(peers, key=lambda x: (x.schema_version,
-                                              -len(x.running_rabbits),
-                                              x.node))
-        self.logger.info("Bootstrapping %s" % bootstrap.node)
+        # Node names are unique, so the peer itself is never compared
+        (_version, _running, _node, bootstrap) = max(
+            (state.version, -len(state.running), x.node, x)
+            for (x, state) in peers
+        )
+        self.logger.info("Bootstrapping %s", bootstrap.node)
         return bootstrap
 
+    def trigger_promote_next(self):
+        """Trigger promotion of the next remaining peer (if any)"""
+        active = self.meta_notify_active_unames
+        for peer in self.all_peers:
+            if peer == self:
+                continue
+            if active is not None and peer.node not in active:
+                continue
+            if not peer.score:
+                self.logger.info("Triggering promotion of %s", peer.node)
+                peer.trigger_promote()
+                return
+
+    def trigger_promote_all(self):
+        """Trigger promotion of all other nodes
+
+        Concurrent attempts to join the same RabbitMQ cluster are
+        prone to failure, so the remaining nodes are promoted one at a
+        time: each node triggers promotion of the next once it has
+        joined the cluster.
+        """
+        self.trigger_promote_next()
+
+    def trigger_promote_bootstrap(self):
+        """Trigger promotion of bootstrap node (if any)
+
+        Joining nodes are promoted one at a time, so the promotion
+        chain will stall if a triggered peer is subsequently stopped
+        (e.g. after repeated failures to join).  Recover by allowing
+        the first waiting slave to promote itself once a master is
+        running and no other promotion remains pending.
+
+        Masters are identifiable as started peers with no recorded
+        state, since the state is deleted once the application has
+        started.
+        """
+        peers = [(x, x.state) for x in self.all_peers if x.started]
+        if all(state is not None for (_x, state) in peers):
+            super(RabbitAgent, self).trigger_promote_bootstrap()
+            return
+        waiting = [x for (x, state) in peers if state is not None]
+        if any(x.score for x in waiting):
+            return
+        if waiting and waiting[0] == self:
+            self.logger.info("Triggering promotion to join running master")
+            self.trigger_promote()
+
     def service_start(self):
         """Start slave service"""
         # Start service
         self.systemctl_start(self.service)
-        # Ensure application is stopped
-        if self.app_is_running:
-            self.rabbitmqctl_stop_app()
-        # Record state
-        self.state = self.read_state()
+        # Ensure application is stopped and record state
+        self.state = self.read_state(ensure_app_stopped=True)
 
     def master_start(self):
         """Start master service"""
@@ -262,24 +386,29 @@ class RabbitAgent(BootstrappingAgent):
                 self.join(master.rabbit)
         # Start application
         self.rabbitmqctl_start_app()
-        # Forget any stale cluster nodes, if applicable
         if self.is_bootstrap:
+            # Forget any stale cluster nodes
             old = set(self.known_rabbits)
-            new = set(peer.rabbit for peer in self.all_peers)
+            new = {peer.rabbit for peer in self.all_peers}
             forget = (old - new)
-            for rabbit in forget:
-                self.forget(rabbit)
+            if forget:
+                self.forget(*sorted(forget))
+        else:
+            # Allow the next remaining peer to join.  Do not allow a
+            # failure to do so to break an otherwise successful join.
+            # pylint: disable=locally-disabled, broad-except
+            try:
+                self.trigger_promote_next()
+            except Exception as e:
+                self.logger.exception(str(e))
         # Clear stored state
         del self.state
 
     def master_stop(self):
         """Stop master service"""
-        # Stop application
-        if self.app_is_running:
-            self.rabbitmqctl_stop_app()
-        # Record state
-        self.state = self.read_state()
+        # Stop application and record state
+        self.state = self.read_state(ensure_app_stopped=True)
 
     @property
     def master_is_running(self):
-        return self.service_is_running and self.app_is_running
+        return self.app_is_running